@@ -1,34 +1,50 @@
 import streamlit as st
 import os
-import tempfile
 import re
 from pathlib import Path
 import io
+import hashlib
+import zipfile
+import json
+import threading
+import sqlite3
+from contextlib import closing
+import time
+import asyncio
+import importlib.util
 
-# 导入基本依赖
-try:
-    from PyPDF2 import PdfReader
-    PDF_SUPPORT = True
-except ImportError:
-    PDF_SUPPORT = False
-
-try:
-    import docx
-    DOCX_SUPPORT = True
-except ImportError:
-    DOCX_SUPPORT = False
+# 检查可选依赖，实际导入推迟到首次使用时，加快冷启动
+def _has_module(name):
+    """检查模块是否已安装，不执行模块的导入"""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
 
-try:
-    from PIL import Image
-    IMAGE_SUPPORT = True
-except ImportError:
-    IMAGE_SUPPORT = False
+PYMUPDF_SUPPORT = _has_module("pymupdf")
+PYPDFIUM2_SUPPORT = _has_module("pypdfium2")
+PDF_SUPPORT = _has_module("PyPDF2")
+DOCX_SUPPORT = _has_module("docx")
+DOCX_XML_SUPPORT = _has_module("lxml")
+IMAGE_SUPPORT = _has_module("PIL")
+DISKCACHE_SUPPORT = _has_module("diskcache")
+SEMANTIC_CACHE_SUPPORT = all(_has_module(name) for name in ("faiss", "numpy", "sentence_transformers"))
 
-# 导入 LangChain 相关库
+# 导入 LangChain 相关库（openai和tenacity随LangChain一同安装）
+import openai
+from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_exception_type
 from langchain.llms import OpenAI
 from langchain.prompts import PromptTemplate
 from langchain.chains import LLMChain
-from langchain.callbacks.streamlit import StreamlitCallbackHandler
+
+# 文本清理用的预编译正则和转换表
+_WS_RE = re.compile(r'\s+')
+_JUNK_RE = re.compile(r'\{\.(?:mark|underline)\}')
+_CLEAN_TABLE = str.maketrans({'\x00': None})
+# 上传文件名清理用的预编译正则
+_SAFE_NAME_RE = re.compile(r'[^\w.\-]')
+# 批量分析回复中包裹JSON的代码块标记
+_CODE_FENCE_RE = re.compile(r'^\s*```[\w-]*\s*$', re.MULTILINE)
 
 # 页面配置
 st.set_page_config(
@@ -38,8 +54,29 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# 每次请求的最大输出token数
+LLM_MAX_TOKENS = 2000
+
 # 设置API客户端
-def get_langchain_llm(model_type="simplify", stream=False, st_container=None):
+def _build_llm(model_name, api_key, api_base, temperature, stream):
+    """创建LangChain LLM客户端"""
+    return OpenAI(
+        model_name=model_name,
+        openai_api_key=api_key,
+        openai_api_base=api_base,
+        streaming=stream,
+        temperature=temperature,
+        max_tokens=LLM_MAX_TOKENS,  # 减少输出长度限制
+        request_timeout=60,  # 增加超时时间到60秒
+        max_retries=0,  # 重试由llm_retry统一处理
+        presence_penalty=0.1,  # 添加存在惩罚以减少重复
+        frequency_penalty=0.1  # 添加频率惩罚以减少重复
+    )
+
+# 相同配置的客户端在各次运行间复用
+_make_llm = st.cache_resource(show_spinner=False)(_build_llm)
+
+def get_langchain_llm(model_type="simplify", stream=False, reuse_client=True):
     """根据不同的模型类型设置API客户端"""
     # 使用OpenRouter API
     api_base = "https://openrouter.ai/api/v1"
@@ -60,220 +97,939 @@ def get_langchain_llm(model_type="simplify", stream=False, st_container=None):
         st.error(f"{'素材分析' if model_type == 'simplify' else '脑暴报告'} API密钥未设置！请在secrets.toml中配置。")
         st.stop()
     
-    # 设置回调处理器
-    callbacks = None
-    if stream and st_container:
-        callbacks = [StreamlitCallbackHandler(st_container)]
+    # 复用已创建的客户端及其连接池；异步调用的连接池绑定事件循环，需要新建
+    make_llm = _make_llm if reuse_client else _build_llm
+    return make_llm(model_name, api_key, api_base, temperature, stream)
+
+# LLM响应缓存
+LLM_CACHE_DIR = ".llm_cache"
+LLM_CACHE_EXPIRE = 7 * 86400  # 缓存保留7天
+
+class SqliteCache:
+    """未安装diskcache时使用的SQLite缓存，提供相同的get/set接口"""
     
-    # 创建LangChain LLM客户端 - 简化配置
-    llm = OpenAI(
-        model_name=model_name,
-        openai_api_key=api_key,
-        openai_api_base=api_base,
-        streaming=stream,
-        temperature=temperature,
-        max_tokens=2000,  # 减少输出长度限制
-        callbacks=callbacks,
-        request_timeout=60,  # 增加超时时间到60秒
-        max_retries=3,  # 添加重试机制
-        presence_penalty=0.1,  # 添加存在惩罚以减少重复
-        frequency_penalty=0.1  # 添加频率惩罚以减少重复
+    def __init__(self, cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, "llm_cache.sqlite3")
+        with closing(self._connect()) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expire_at REAL)")
+    
+    def _connect(self):
+        # 每次操作使用独立连接，可在任意线程中调用
+        return sqlite3.connect(self.path, timeout=30)
+    
+    def get(self, key):
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute("SELECT value, expire_at FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return row[0]
+    
+    def set(self, key, value, expire):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expire_at) VALUES (?, ?, ?)",
+                (key, value, time.time() + expire)
+            )
+
+@st.cache_resource
+def get_llm_cache():
+    """获取持久化的LLM响应缓存，优先使用diskcache"""
+    if DISKCACHE_SUPPORT:
+        import diskcache
+        return diskcache.Cache(LLM_CACHE_DIR)
+    return SqliteCache(LLM_CACHE_DIR)
+
+def _llm_cache_key(llm, prompt_text):
+    """以模型名称、温度和完整提示词计算缓存键"""
+    key_source = llm.model_name + str(llm.temperature) + prompt_text
+    return hashlib.blake2b(key_source.encode("utf-8")).hexdigest()
+
+def _use_llm_cache():
+    return st.session_state.get("use_cache", True)
+
+# 分析结果去除空白后少于该长度视为无效
+MIN_RESULT_LENGTH = 11
+
+def _is_valid_result(result, min_length=MIN_RESULT_LENGTH):
+    """判断LLM返回的结果是否有效，只有有效结果才写入缓存"""
+    return bool(result) and len(result.strip()) >= min_length
+
+# 对临时性的API错误进行指数退避重试，其他错误直接抛出
+llm_retry = retry(
+    wait=wait_exponential(multiplier=1, max=30),
+    stop=stop_after_attempt(4),
+    retry=retry_if_exception_type((
+        openai.APIConnectionError,
+        openai.APITimeoutError,
+        openai.RateLimitError,
+        openai.InternalServerError,
+    )),
+    reraise=True,
+)
+
+# 流式输出时每收到多少个token刷新一次页面
+STREAM_RENDER_EVERY = 20
+
+def _stream_to_container(st_container, tokens):
+    """将token流写入容器，每STREAM_RENDER_EVERY个token刷新一次，返回完整文本"""
+    buf = []
+    for i, token in enumerate(tokens, 1):
+        buf.append(token)
+        if i % STREAM_RENDER_EVERY == 0:
+            st_container.markdown("".join(buf))
+    text = "".join(buf)
+    st_container.markdown(text)
+    return text
+
+@llm_retry
+def run_llm(chain, st_container=None, **kwargs):
+    """执行LLMChain；传入容器时直接迭代llm.stream()，将生成的文本流式写入容器"""
+    if st_container is None:
+        return chain.run(**kwargs)
+    return _stream_to_container(st_container, chain.llm.stream(chain.prompt.format(**kwargs)))
+
+def cached_llm_run(chain, st_container=None, min_length=MIN_RESULT_LENGTH, **kwargs):
+    """执行LLMChain，相同的模型、温度和完整提示词直接返回缓存结果；只缓存长度不少于min_length的结果"""
+    if not _use_llm_cache():
+        return run_llm(chain, st_container, **kwargs)
+    
+    key = _llm_cache_key(chain.llm, chain.prompt.format(**kwargs))
+    cache = get_llm_cache()
+    result = cache.get(key)
+    if result is not None:
+        return result
+    
+    result = run_llm(chain, st_container, **kwargs)
+    if _is_valid_result(result, min_length):
+        cache.set(key, result, expire=LLM_CACHE_EXPIRE)
+    return result
+
+@llm_retry
+async def arun_llm(chain, **kwargs):
+    """异步执行LLMChain"""
+    return await chain.arun(**kwargs)
+
+@llm_retry
+def generate_llm(llm, prompt_texts):
+    """在一次请求中批量生成多个提示词的结果"""
+    return llm.generate(prompt_texts)
+
+async def cached_llm_arun(chain, min_length=MIN_RESULT_LENGTH, **kwargs):
+    """cached_llm_run的异步版本"""
+    if not _use_llm_cache():
+        return await arun_llm(chain, **kwargs)
+    
+    key = _llm_cache_key(chain.llm, chain.prompt.format(**kwargs))
+    cache = get_llm_cache()
+    result = cache.get(key)
+    if result is not None:
+        return result
+    
+    result = await arun_llm(chain, **kwargs)
+    if _is_valid_result(result, min_length):
+        cache.set(key, result, expire=LLM_CACHE_EXPIRE)
+    return result
+
+# 语义缓存：对轻微修改过的文档或研究方向复用分析结果
+SEMANTIC_MODEL_NAME = "paraphrase-multilingual-MiniLM-L12-v2"  # 支持中文的多语言模型
+# 不同模型的向量不可比较，按模型分目录存储
+SEMANTIC_CACHE_DIR = os.path.join(LLM_CACHE_DIR, "semantic", SEMANTIC_MODEL_NAME)
+SEMANTIC_THRESHOLD = 0.95  # 文档内容向量的余弦相似度阈值
+SEMANTIC_DIRECTION_THRESHOLD = 0.9  # 研究方向向量的余弦相似度阈值
+SEMANTIC_CONTENT_THRESHOLD = 0.8  # 文档内容MinHash估计的Jaccard相似度阈值
+SEMANTIC_WINDOW_LENGTH = 128  # 模型最多读取128个token，按该长度分段向量化
+SEMANTIC_SEARCH_K = 10  # 每次查找比较的候选条数
+SEMANTIC_SHINGLE_LENGTH = 5  # MinHash签名使用的字符片段长度
+SEMANTIC_SIGNATURE_SIZE = 128  # MinHash签名保留的最小哈希值个数
+SEMANTIC_CACHE_EXPIRE = LLM_CACHE_EXPIRE
+
+def _normalize_direction(direction):
+    """统一研究方向的空白和大小写"""
+    return " ".join(direction.split()).lower()
+
+def _content_signature(text):
+    """计算文本的bottom-k MinHash签名，不保存原文即可估计两段文本的相似度"""
+    hashes = {
+        int.from_bytes(hashlib.blake2b(text[i:i + SEMANTIC_SHINGLE_LENGTH].encode("utf-8"), digest_size=8).digest(), "big")
+        for i in range(max(1, len(text) - SEMANTIC_SHINGLE_LENGTH + 1))
+    }
+    return sorted(hashes)[:SEMANTIC_SIGNATURE_SIZE]
+
+def _signature_similarity(a, b):
+    """由两个bottom-k签名估计字符片段集合的Jaccard相似度"""
+    union = sorted(set(a) | set(b))[:SEMANTIC_SIGNATURE_SIZE]
+    if not union:
+        return 1.0
+    both = set(a) & set(b)
+    return sum(1 for h in union if h in both) / len(union)
+
+def _atomic_write(path, write):
+    """先写入临时文件再替换，避免中断时留下不完整的文件"""
+    tmp_path = path + ".tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+class SemanticCache:
+    """基于句向量余弦相似度的近似匹配缓存，命中前再核对研究方向和文档内容"""
+    
+    def __init__(self, cache_dir, model_name, threshold, window_length, expire):
+        import faiss
+        import numpy as np
+        from sentence_transformers import SentenceTransformer
+        
+        self.threshold = threshold
+        self.window_length = window_length
+        self.expire = expire
+        self.index_path = os.path.join(cache_dir, "index.faiss")
+        self.entries_path = os.path.join(cache_dir, "entries.json")
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        
+        self.model = SentenceTransformer(model_name)
+        dimension = self.model.get_sentence_embedding_dimension()
+        self.index = faiss.IndexFlatIP(dimension)
+        self.entries = []
+        
+        # 加载已持久化的索引和结果，丢弃过期或格式不完整的条目
+        if os.path.exists(self.index_path) and os.path.exists(self.entries_path):
+            index = faiss.read_index(self.index_path)
+            with open(self.entries_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            if index.ntotal == len(entries):
+                now = time.time()
+                keep = [
+                    idx for idx, entry in enumerate(entries)
+                    if "signature" in entry and entry.get("expire_at", 0) > now
+                ]
+                if keep:
+                    self.index.add(np.stack([index.reconstruct(idx) for idx in keep]))
+                    self.entries = [entries[idx] for idx in keep]
+    
+    def _embed(self, text):
+        import numpy as np
+        
+        # 模型会截断过长的输入，分段向量化后取平均，使全部内容都参与比较
+        windows = [text[i:i + self.window_length] for i in range(0, len(text), self.window_length)] or [""]
+        vectors = self.model.encode(windows, normalize_embeddings=True)
+        vector = np.mean(vectors, axis=0, keepdims=True)
+        # 归一化后内积即为余弦相似度
+        vector /= max(np.linalg.norm(vector), 1e-12)
+        return np.asarray(vector, dtype="float32")
+    
+    def _same_direction(self, direction, cached_direction):
+        """研究方向相同或语义足够相近"""
+        import numpy as np
+        
+        if _normalize_direction(direction) == _normalize_direction(cached_direction):
+            return True
+        vectors = self.model.encode([direction, cached_direction], normalize_embeddings=True)
+        return float(np.dot(vectors[0], vectors[1])) >= SEMANTIC_DIRECTION_THRESHOLD
+    
+    def lookup(self, content, direction, prompt_key):
+        """查找内容向量相近、提示词一致、研究方向和内容都核对通过的缓存结果"""
+        vector = self._embed(content)
+        with self.lock:
+            if self.index.ntotal == 0:
+                return None
+            # 取最相近的若干条作为候选
+            scores, ids = self.index.search(vector, min(SEMANTIC_SEARCH_K, self.index.ntotal))
+            candidates = []
+            now = time.time()
+            for score, idx in zip(scores[0], ids[0]):
+                if idx < 0 or score < self.threshold:
+                    break
+                entry = self.entries[idx]
+                if entry["prompt_key"] == prompt_key and entry["expire_at"] > now:
+                    candidates.append(entry)
+        
+        if not candidates:
+            return None
+        signature = _content_signature(content)
+        for entry in candidates:
+            if (_signature_similarity(signature, entry["signature"]) >= SEMANTIC_CONTENT_THRESHOLD
+                    and self._same_direction(direction, entry["direction"])):
+                return entry["result"]
+        return None
+    
+    def add(self, content, direction, prompt_key, result):
+        """写入新的缓存结果并持久化到磁盘"""
+        import faiss
+        
+        vector = self._embed(content)
+        entry = {
+            "prompt_key": prompt_key,
+            "direction": direction,
+            "signature": _content_signature(content),
+            "expire_at": time.time() + self.expire,
+            "result": result,
+        }
+        with self.lock:
+            self.index.add(vector)
+            self.entries.append(entry)
+            
+            def write_entries(path):
+                with open(path, 'w', encoding='utf-8') as f:
+                    json.dump(self.entries, f, ensure_ascii=False)
+            
+            _atomic_write(self.index_path, lambda path: faiss.write_index(self.index, path))
+            _atomic_write(self.entries_path, write_entries)
+
+@st.cache_resource(show_spinner=False)
+def get_semantic_cache():
+    """获取全局共享的语义缓存"""
+    return SemanticCache(
+        SEMANTIC_CACHE_DIR, SEMANTIC_MODEL_NAME, SEMANTIC_THRESHOLD, SEMANTIC_WINDOW_LENGTH, SEMANTIC_CACHE_EXPIRE
     )
+
+# DOCX解析
+W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+W_BODY, W_P, W_R, W_T, W_TBL = W_NS + "body", W_NS + "p", W_NS + "r", W_NS + "t", W_NS + "tbl"
+W_TR, W_TC, W_HYPERLINK, W_VAL = W_NS + "tr", W_NS + "tc", W_NS + "hyperlink", W_NS + "val"
+
+# 根据字号识别标题只是启发式规则，默认关闭以省去逐个文本片段读取字号
+ENABLE_HEADING_DETECTION = False
+
+def _format_run(text, bold, italic, underline, size_pt):
+    """将文本片段的格式转换为Markdown标记"""
+    # 加粗、斜体、下划线由内向外包裹
+    prefix = suffix = ""
+    if bold:
+        prefix, suffix = "**", "**"
+    if italic:
+        prefix, suffix = "*" + prefix, suffix + "*"
+    if underline:
+        prefix, suffix = "__" + prefix, suffix + "__"
+    # 字号较大的文本视为标题
+    if size_pt and size_pt > 11:
+        prefix = ("# " if size_pt > 14 else "## ") + prefix
+    return f"{prefix}{text}{suffix}"
+
+def _format_table(table_idx, rows):
+    """将表格的单元格文本转换为内容片段"""
+    if not rows:
+        return []
+    
+    # 添加表格标记
+    parts = [f"\n## 表格 {table_idx+1}"]
+    
+    # 判断表格类型和结构
+    is_questionnaire = False
+    if len(rows) > 1 and len(rows[0]) > 0:
+        # 检查第一行是否可能是表头
+        header_row = [cell.strip() for cell in rows[0]]
+        is_questionnaire = any("问题" in cell or "题" in cell for cell in header_row) or len(header_row) >= 2
+    
+    if is_questionnaire:
+        # 特殊处理问卷表格，按行分组
+        headers = [cell.strip() for cell in rows[0]]
+        
+        # 处理内容行
+        for row in rows[1:]:
+            row_content = []
+            for col_idx, cell in enumerate(row):
+                cell_text = cell.strip()
+                # 如果有表头且内容不为空，关联显示
+                if cell_text and col_idx < len(headers) and headers[col_idx]:
+                    row_content.append(f"{headers[col_idx]}: {cell_text}")
+                elif cell_text:
+                    row_content.append(cell_text)
+            
+            # 只添加非空内容
+            if row_content:
+                parts.append(" | ".join(row_content))
+    else:
+        # 常规表格处理
+        for row in rows:
+            row_texts = []
+            for cell in row:
+                cell_text = cell.strip()
+                if cell_text:
+                    # 替换可能导致格式问题的字符
+                    cell_text = cell_text.replace('\n', ' ').replace('|', '/')
+                    row_texts.append(cell_text)
+            
+            # 只添加非空行
+            if row_texts:
+                parts.append(" | ".join(row_texts))
+    
+    return parts
+
+def _xml_is_on(elem):
+    """判断w:b、w:i等开关属性是否开启"""
+    return elem is not None and elem.get(W_VAL, "true").lower() not in ("0", "false", "off")
+
+def _xml_runs(p):
+    """按顺序返回段落中的w:r元素，包括超链接中的"""
+    for child in p:
+        if child.tag == W_R:
+            yield child
+        elif child.tag == W_HYPERLINK:
+            yield from child.iterchildren(W_R)
+
+def _xml_run_text(r):
+    """提取w:r中的文本，与python-docx的run.text一致"""
+    parts = []
+    for child in r:
+        if child.tag == W_T:
+            parts.append(child.text or "")
+        elif child.tag == W_NS + "tab":
+            parts.append("\t")
+        elif child.tag in (W_NS + "br", W_NS + "cr"):
+            parts.append("\n")
+    return "".join(parts)
+
+def _xml_paragraph_text(p):
+    """提取段落中带格式标记的文本"""
+    parts = []
+    for r in _xml_runs(p):
+        text = _xml_run_text(r).strip()
+        if not text:
+            continue
+        
+        bold = italic = underline = False
+        size_pt = None
+        rpr = r.find(W_NS + "rPr")
+        if rpr is not None:
+            bold = _xml_is_on(rpr.find(W_NS + "b"))
+            italic = _xml_is_on(rpr.find(W_NS + "i"))
+            u = rpr.find(W_NS + "u")
+            underline = u is not None and u.get(W_VAL, "single") != "none"
+            sz = rpr.find(W_NS + "sz") if ENABLE_HEADING_DETECTION else None
+            if sz is not None:
+                size_pt = int(sz.get(W_VAL)) / 2  # w:sz单位为半磅
+        
+        parts.append(_format_run(text, bold, italic, underline, size_pt))
+    return " ".join(parts)
+
+def _xml_table_rows(tbl):
+    """提取表格每行的单元格文本，合并单元格按网格展开"""
+    rows = []
+    prev_cells = []
+    for tr in tbl.iterchildren(W_TR):
+        cells = []
+        for tc in tr.iterchildren(W_TC):
+            span = 1
+            continues_above = False
+            tcpr = tc.find(W_NS + "tcPr")
+            if tcpr is not None:
+                grid_span = tcpr.find(W_NS + "gridSpan")
+                if grid_span is not None:
+                    span = int(grid_span.get(W_VAL, "1"))
+                v_merge = tcpr.find(W_NS + "vMerge")
+                continues_above = v_merge is not None and v_merge.get(W_VAL, "continue") == "continue"
+            
+            # 纵向合并的单元格沿用上一行的内容
+            if continues_above and len(cells) < len(prev_cells):
+                text = prev_cells[len(cells)]
+            else:
+                text = "\n".join(
+                    "".join(_xml_run_text(r) for r in _xml_runs(p))
+                    for p in tc.iterchildren(W_P)
+                )
+            cells.extend([text] * span)
+        rows.append(cells)
+        prev_cells = cells
+    return rows
+
+def _read_docx_xml(docx_file):
+    """使用lxml iterparse流式解析word/document.xml，返回内容片段"""
+    from lxml import etree
     
-    return llm
+    paragraphs = []
+    tables = []
+    with zipfile.ZipFile(docx_file) as z, z.open("word/document.xml") as f:
+        for _, elem in etree.iterparse(f, events=("end",), tag=(W_P, W_TBL)):
+            # 只处理正文顶层的段落和表格，表格内的段落随表格一起处理
+            parent = elem.getparent()
+            if parent is None or parent.tag != W_BODY:
+                continue
+            
+            if elem.tag == W_P:
+                text = _xml_paragraph_text(elem)
+                if text:
+                    paragraphs.append(text)
+            else:
+                tables.append(_xml_table_rows(elem))
+            
+            # 释放已处理的元素
+            elem.clear()
+            while elem.getprevious() is not None:
+                del parent[0]
+    
+    content_parts = paragraphs
+    for table_idx, rows in enumerate(tables):
+        content_parts.extend(_format_table(table_idx, rows))
+    return content_parts
+
+def _read_docx_python_docx(docx_file):
+    """使用python-docx解析DOCX文件，返回内容片段"""
+    import docx
+    
+    doc = docx.Document(docx_file)
+    content_parts = []
+    
+    # 提取段落文本，直接遍历底层w:p元素中的w:r，避免python-docx逐个解析run属性
+    for para in doc.paragraphs:
+        para_text = _xml_paragraph_text(para._p)
+        if para_text:
+            content_parts.append(para_text)
+    
+    # 提取表格内容，直接遍历底层w:tbl元素，避免python-docx反复重建单元格网格
+    for table_idx, table in enumerate(doc.tables):
+        rows = _xml_table_rows(table._tbl)
+        content_parts.extend(_format_table(table_idx, rows))
+    
+    return content_parts
+
+# 调试日志
+def dbg(*args, **kwargs):
+    """仅在侧边栏开启调试日志时输出"""
+    if st.session_state.get("debug"):
+        st.write(*args, **kwargs)
+
+def _show_log(level, message):
+    """输出一条日志，普通信息只在调试模式下显示"""
+    if level == "write":
+        dbg(message)
+    else:
+        getattr(st, level)(message)
 
 # 文件处理函数
-def process_file(file_path, file_type):
-    """处理不同类型的文件并返回内容"""
+def _emit_log(logs, level, message):
+    """输出日志；传入列表时先收集，由主线程统一输出"""
+    if logs is None:
+        _show_log(level, message)
+    else:
+        logs.append((level, message))
+
+def _read_docx(file_bytes, file_name, logs):
+    """读取DOCX文件内容"""
     try:
-        # 检查文件是否存在并有内容
-        if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
-            return f"警告: 文件 {os.path.basename(file_path)} 为空或不存在"
-            
-        if file_type == "docx" and DOCX_SUPPORT:
-            try:
-                # 使用python-docx处理
-                doc = docx.Document(file_path)
-                content_parts = []
-                
-                # 提取段落文本
-                for para in doc.paragraphs:
-                    if para.text.strip():
-                        # 增强格式处理，保留更多格式信息
-                        para_text = ""
-                        for run in para.runs:
-                            text = run.text.strip()
-                            if not text:
-                                continue
-                                
-                            # 处理加粗
-                            if run.bold:
-                                text = f"**{text}**"
-                            # 处理斜体
-                            if run.italic:
-                                text = f"*{text}*"
-                            # 处理下划线
-                            if run.underline:
-                                text = f"__{text}__"
-                            # 处理字体大小
-                            if run.font.size:
-                                size = run.font.size.pt if run.font.size.pt else 11
-                                if size > 11:
-                                    text = f"# {text}" if size > 14 else f"## {text}"
-                            
-                            para_text += text + " "
-                        
-                        # 清理多余空格并添加段落
-                        if para_text.strip():
-                            content_parts.append(para_text.strip())
-                
-                # 提取表格内容
-                for table_idx, table in enumerate(doc.tables):
-                    if len(table.rows) == 0:
-                        continue
-                    
-                    # 添加表格标记
-                    content_parts.append(f"\n## 表格 {table_idx+1}")
-                    
-                    # 判断表格类型和结构
-                    is_questionnaire = False
-                    if len(table.rows) > 1 and len(table.rows[0].cells) > 0:
-                        # 检查第一行是否可能是表头
-                        header_row = [cell.text.strip() for cell in table.rows[0].cells]
-                        is_questionnaire = any("问题" in cell or "题" in cell for cell in header_row) or len(header_row) >= 2
-                    
-                    if is_questionnaire:
-                        # 特殊处理问卷表格，按行分组
-                        headers = []
-                        for cell in table.rows[0].cells:
-                            headers.append(cell.text.strip())
-                        
-                        # 处理内容行
-                        for row_idx in range(1, len(table.rows)):
-                            row_content = []
-                            for col_idx, cell in enumerate(table.rows[row_idx].cells):
-                                cell_text = cell.text.strip()
-                                # 如果有表头且内容不为空，关联显示
-                                if cell_text and col_idx < len(headers) and headers[col_idx]:
-                                    row_content.append(f"{headers[col_idx]}: {cell_text}")
-                                elif cell_text:
-                                    row_content.append(cell_text)
-                            
-                            # 只添加非空内容
-                            if row_content:
-                                content_parts.append(" | ".join(row_content))
-                    else:
-                        # 常规表格处理
-                        for row in table.rows:
-                            row_texts = []
-                            for cell in row.cells:
-                                cell_text = cell.text.strip()
-                                if cell_text:
-                                    # 替换可能导致格式问题的字符
-                                    cell_text = cell_text.replace('\n', ' ').replace('|', '/')
-                                    row_texts.append(cell_text)
-                            
-                            # 只添加非空行
-                            if row_texts:
-                                content_parts.append(" | ".join(row_texts))
-                
-                # 合并所有内容，添加适当的换行
-                content = "\n\n".join(content_parts)
-                
-                # 记录日志
-                st.write(f"从DOCX文件 {os.path.basename(file_path)} 读取了 {len(content)} 字符")
-                    
-                # 后处理，清理可能的重复内容和格式标记
-                content = content.replace('{.mark}', '').replace('{.underline}', '')
-                
-                # 确保内容不为空
-                if not content.strip():
-                    return f"警告: 文件 {os.path.basename(file_path)} 内容为空"
-                
-                return content
-            except Exception as e:
-                error_msg = f"读取DOCX文件时出错: {str(e)}"
-                st.error(error_msg)
-                return error_msg
-                
-        elif file_type == "pdf" and PDF_SUPPORT:
+        # 优先使用lxml流式解析，失败时回退到python-docx
+        content_parts = None
+        if DOCX_XML_SUPPORT:
             try:
-                pdf_reader = PdfReader(file_path)
-                text = ""
-                for page in pdf_reader.pages:
-                    text += page.extract_text() + "\n"
-                st.write(f"从PDF文件 {os.path.basename(file_path)} 读取了 {len(text)} 字符")
-                return text
+                content_parts = _read_docx_xml(io.BytesIO(file_bytes))
             except Exception as e:
-                error_msg = f"读取PDF文件时出错: {str(e)}"
-                st.error(error_msg)
-                return error_msg
-        elif file_type in ["jpg", "jpeg", "png"] and IMAGE_SUPPORT:
-            # 简单记录图像信息，而不进行OCR
+                _emit_log(logs, "write", f"流式解析DOCX文件失败，改用python-docx: {str(e)}")
+        if content_parts is None:
+            content_parts = _read_docx_python_docx(io.BytesIO(file_bytes))
+        
+        # 合并所有内容，添加适当的换行
+        content = "\n\n".join(content_parts)
+        
+        # 记录日志
+        _emit_log(logs, "write", f"从DOCX文件 {file_name} 读取了 {len(content)} 字符")
+        
+        # 确保内容不为空
+        if not content.strip():
+            return f"警告: 文件 {file_name} 内容为空"
+        
+        return content
+    except Exception as e:
+        error_msg = f"读取DOCX文件时出错: {str(e)}"
+        _emit_log(logs, "error", error_msg)
+        return error_msg
+
+# OLE复合文档（旧版Word二进制格式）的文件头
+_OLE_SIGNATURE = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+
+def _read_doc(file_bytes, file_name, logs):
+    """读取DOC文件，旧版二进制格式无法提取文本时直接提示转换"""
+    if file_bytes.startswith(_OLE_SIGNATURE):
+        error_msg = f"文件 {file_name} 是旧版Word二进制格式，无法直接读取，请另存为DOCX后重新上传"
+        _emit_log(logs, "error", error_msg)
+        return error_msg
+    
+    # 部分.doc文件实际是文本或HTML格式，按文本文件读取
+    return _read_text(file_bytes, file_name, logs)
+
+def _read_pdf(file_bytes, file_name, logs):
+    """读取PDF文件的文本内容"""
+    try:
+        # 优先使用基于MuPDF的pymupdf，其次是基于PDFium的pypdfium2，都未安装时回退到PyPDF2
+        if PYMUPDF_SUPPORT:
+            import pymupdf
+            with pymupdf.open(stream=file_bytes, filetype="pdf") as pdf_doc:
+                text = "\n".join(page.get_text("text") for page in pdf_doc)
+        elif PYPDFIUM2_SUPPORT:
+            import pypdfium2 as pdfium
+            pdf_doc = pdfium.PdfDocument(file_bytes)
             try:
-                image = Image.open(file_path)
-                width, height = image.size
-                info = f"[图像文件，尺寸: {width}x{height}，类型: {image.format}。请在分析时考虑此图像可能包含的视觉内容。]"
-                st.write(f"处理图像文件: {os.path.basename(file_path)}")
-                return info
-            except Exception as e:
-                error_msg = f"处理图像文件时出错: {str(e)}"
-                st.error(error_msg)
-                return error_msg
+                text = "\n".join(page.get_textpage().get_text_range() for page in pdf_doc)
+            finally:
+                pdf_doc.close()
         else:
-            # 尝试作为文本文件读取
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                    st.write(f"从文本文件 {os.path.basename(file_path)} 读取了 {len(content)} 字符")
-                    return content
-            except UnicodeDecodeError:
-                try:
-                    with open(file_path, 'rb') as f:
-                        content = f.read().decode('utf-8', errors='ignore')
-                        st.write(f"从二进制文件 {os.path.basename(file_path)} 读取了 {len(content)} 字符")
-                        return content
-                except Exception as e:
-                    error_msg = f"以二进制模式读取文件时出错: {str(e)}"
-                    st.error(error_msg)
-                    return error_msg
-            except Exception as e:
-                error_msg = f"读取文本文件时出错: {str(e)}"
-                st.error(error_msg)
-                return error_msg
+            from PyPDF2 import PdfReader
+            pdf_reader = PdfReader(io.BytesIO(file_bytes))
+            text = "\n".join(page.extract_text() or "" for page in pdf_reader.pages)
+        _emit_log(logs, "write", f"从PDF文件 {file_name} 读取了 {len(text)} 字符")
+        return text
+    except Exception as e:
+        error_msg = f"读取PDF文件时出错: {str(e)}"
+        _emit_log(logs, "error", error_msg)
+        return error_msg
+
+def _read_image(file_bytes, file_name, logs):
+    """记录图像文件的基本信息"""
+    # 简单记录图像信息，而不进行OCR
+    try:
+        from PIL import Image
+        image = Image.open(io.BytesIO(file_bytes))
+        width, height = image.size
+        info = f"[图像文件，尺寸: {width}x{height}，类型: {image.format}。请在分析时考虑此图像可能包含的视觉内容。]"
+        _emit_log(logs, "write", f"处理图像文件: {file_name}")
+        return info
+    except Exception as e:
+        error_msg = f"处理图像文件时出错: {str(e)}"
+        _emit_log(logs, "error", error_msg)
+        return error_msg
+
+def _read_text(file_bytes, file_name, logs):
+    """尝试作为文本文件读取"""
+    try:
+        content = file_bytes.decode('utf-8')
+        _emit_log(logs, "write", f"从文本文件 {file_name} 读取了 {len(content)} 字符")
+        return content
+    except UnicodeDecodeError:
+        try:
+            content = file_bytes.decode('utf-8', errors='ignore')
+            _emit_log(logs, "write", f"从二进制文件 {file_name} 读取了 {len(content)} 字符")
+            return content
+        except Exception as e:
+            error_msg = f"以二进制模式读取文件时出错: {str(e)}"
+            _emit_log(logs, "error", error_msg)
+            return error_msg
+    except Exception as e:
+        error_msg = f"读取文本文件时出错: {str(e)}"
+        _emit_log(logs, "error", error_msg)
+        return error_msg
+
+# 按文件类型分派处理函数，缺少依赖的类型按文本文件读取
+_FILE_HANDLERS = {"doc": _read_doc}
+if DOCX_SUPPORT:
+    _FILE_HANDLERS["docx"] = _read_docx
+if PYMUPDF_SUPPORT or PYPDFIUM2_SUPPORT or PDF_SUPPORT:
+    _FILE_HANDLERS["pdf"] = _read_pdf
+if IMAGE_SUPPORT:
+    _FILE_HANDLERS.update({"jpg": _read_image, "jpeg": _read_image, "png": _read_image})
+
+def process_file(file_bytes, file_type, file_name, logs=None):
+    """处理不同类型的文件内容并返回文本"""
+    try:
+        # 检查文件是否有内容
+        if not file_bytes:
+            return f"警告: 文件 {file_name} 为空或不存在"
+        
+        handler = _FILE_HANDLERS.get(file_type, _read_text)
+        # 统一清理格式标记，后续分析时无需重复处理
+        return _JUNK_RE.sub('', handler(file_bytes, file_name, logs))
     except Exception as e:
         error_msg = f"处理文件时出错: {str(e)}"
-        st.error(error_msg)
+        _emit_log(logs, "error", error_msg)
         return error_msg
 
+def _sha256_digest(data):
+    """计算文件内容的SHA-256摘要"""
+    return hashlib.sha256(data).hexdigest()
+
+# 解析逻辑变化时递增，与可用的解析依赖一起加入缓存键，使磁盘上的旧结果失效
+_PARSER_VERSION = (2, PYMUPDF_SUPPORT, PYPDFIUM2_SUPPORT, PDF_SUPPORT, DOCX_SUPPORT, DOCX_XML_SUPPORT, IMAGE_SUPPORT)
+# 解析结果的有效期；持久化的st.cache_data不支持ttl，改为把时间段加入缓存键
+PARSE_CACHE_TTL = 7 * 86400
+
+class _UncachedParseResult(Exception):
+    """解析出错时携带结果抛出，st.cache_data不会缓存抛出异常的调用"""
+    
+    def __init__(self, content, logs):
+        super().__init__(content)
+        self.content = content
+        self.logs = logs
+
+@st.cache_data(show_spinner=False, persist="disk", hash_funcs={bytes: _sha256_digest})
+def _process_file_persisted(file_bytes, file_type, file_name, parser_version, ttl_period):
+    """解析文件并缓存结果，parser_version和ttl_period只参与计算缓存键"""
+    logs = []
+    content = process_file(file_bytes, file_type, file_name, logs)
+    if any(level == "error" for level, _ in logs):
+        raise _UncachedParseResult(content, logs)
+    return content, logs
+
+def process_file_cached(file_bytes, file_type, file_name):
+    """按文件内容的SHA-256缓存解析结果（持久化到磁盘），返回内容和解析日志；出错的结果不缓存"""
+    try:
+        return _process_file_persisted(
+            file_bytes, file_type, file_name, _PARSER_VERSION, int(time.time() // PARSE_CACHE_TTL)
+        )
+    except _UncachedParseResult as e:
+        return e.content, e.logs
+
+async def extract_files_async(uploads):
+    """在工作线程中并发解析所有上传文件，按上传顺序返回(文件名, 内容, 日志)"""
+    async def extract(file_name, file_bytes):
+        file_ext = Path(file_name).suffix.lower().replace(".", "")
+        content, logs = await asyncio.to_thread(process_file_cached, file_bytes, file_ext, file_name)
+        return file_name, content, logs
+    
+    return await asyncio.gather(*(extract(file_name, file_bytes) for file_name, file_bytes in uploads))
+
+def _estimate_tokens(text):
+    """粗略估算文本的token数：中文等非ASCII字符约1个token，ASCII字符约4个1个token"""
+    ascii_count = len(text.encode("ascii", "ignore"))
+    return len(text) - ascii_count + ascii_count // 4
+
 # 简化文件内容
 def chunk_content(content, chunk_size=8000):
-    """将内容分块处理"""
-    words = content.split()
+    """将内容在空格处切分为不超过chunk_size字符的块"""
     chunks = []
-    current_chunk = []
-    current_size = 0
-    
-    for word in words:
-        word_size = len(word) + 1  # +1 for space
-        if current_size + word_size > chunk_size:
-            chunks.append(' '.join(current_chunk))
-            current_chunk = [word]
-            current_size = word_size
-        else:
-            current_chunk.append(word)
-            current_size += word_size
+    n = len(content)
+    i = 0
     
-    if current_chunk:
-        chunks.append(' '.join(current_chunk))
+    while i < n:
+        # 跳过块之间的空格
+        if content[i] == ' ':
+            i += 1
+            continue
+        
+        j = min(i + chunk_size, n)
+        if j < n:
+            # 在块末尾之前最近的空格处断开，避免截断单词
+            k = content.rfind(' ', i, j + 1)
+            if k > i:
+                j = k
+        chunks.append(content[i:j].rstrip())
+        i = j
     
     return chunks
 
+def clean_text(content):
+    """清理文本，移除可能导致问题的特殊字符"""
+    return _WS_RE.sub(' ', content.translate(_CLEAN_TABLE))
+
+def _escape_braces(text):
+    """转义管理员提示词中的花括号，避免被当作模板变量"""
+    return text.replace("{", "{{").replace("}", "}}")
+
+@st.cache_resource(show_spinner=False)
+def get_simplify_prompt(backstory, task, output_format):
+    """构建素材分析的提示词模板，提示词不变时直接复用"""
+    template = f"""{_escape_braces(backstory)}
+
+{_escape_braces(task)}
+
+{_escape_braces(output_format)}
+
+重要要求:
+1. 请仔细分析文档内容，提取所有关键信息
+2. 重点关注与研究方向"{{direction}}"相关的内容
+3. 注意识别文档中的主要观点、论据和结论
+4. 输出应为简明扼要的要点，保持原文的层次结构
+5. 确保不遗漏任何重要信息
+6. 如果文档包含表格，请保留表格的结构和内容
+7. 如果文档包含图片，请描述图片的内容和位置
+8. 请确保输出格式清晰，使用适当的标题和列表
+9. 如果遇到无法理解的内容，请保持原文
+10. 不要重复输出相同的内容
+11. 不要生成无意义的重复文本
+12. 保持输出的简洁性和可读性
+
+研究方向: {{direction}}
+
+这是文档的第 {{part}} 部分，请专注于这部分内容。
+文档内容:
+{{chunk}}
+
+请按照以上要求分析文档内容，生成结构化的分析结果。"""
+    
+    return PromptTemplate(
+        template=template,
+        input_variables=["direction", "chunk", "part"]
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_reduce_prompt(backstory, task, output_format):
+    """构建合并各部分分析结果的提示词模板，提示词不变时直接复用"""
+    template = f"""{_escape_braces(backstory)}
+
+{_escape_braces(task)}
+
+{_escape_braces(output_format)}
+
+以下是同一批文档各部分的分析结果，请将它们合并为一份完整的分析结果:
+1. 合并重复的要点，保留所有不同的关键信息
+2. 重点关注与研究方向"{{direction}}"相关的内容
+3. 保持清晰的层次结构，使用适当的标题和列表
+4. 不要添加各部分分析结果中没有的信息
+
+研究方向: {{direction}}
+
+各部分分析结果:
+{{partial_results}}
+
+请输出合并后的结构化分析结果。"""
+    
+    return PromptTemplate(
+        template=template,
+        input_variables=["direction", "partial_results"]
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_batch_simplify_prompt(backstory, task, output_format):
+    """构建一次分析多个编号片段的提示词模板，共享前缀只发送一次"""
+    template = f"""{_escape_braces(backstory)}
+
+{_escape_braces(task)}
+
+{_escape_braces(output_format)}
+
+重要要求:
+1. 请仔细分析每个文档片段，提取所有关键信息
+2. 重点关注与研究方向"{{direction}}"相关的内容
+3. 注意识别文档中的主要观点、论据和结论
+4. 输出应为简明扼要的要点，保持原文的层次结构
+5. 如果文档包含表格，请保留表格的结构和内容
+6. 不要重复输出相同的内容，保持输出的简洁性和可读性
+7. 各片段分别分析，不要混合不同片段的内容
+
+研究方向: {{direction}}
+
+下面共有 {{count}} 个编号的文档片段，每个片段以"[编号] 文件名 (第N部分)"开头。
+请只返回一个JSON数组，数组长度为 {{count}}，第j个元素是对第j个片段的分析结果（Markdown格式的字符串），不要输出JSON数组以外的任何内容。
+
+文档片段:
+{{items}}"""
+    
+    return PromptTemplate(
+        template=template,
+        input_variables=["direction", "count", "items"]
+    )
+
+def _parse_batch_result(text, count):
+    """解析批量分析返回的JSON数组，格式不符时返回None"""
+    # 去掉可能包裹JSON的代码块标记
+    text = _CODE_FENCE_RE.sub("", text)
+    # 回复开头可能有带方括号的说明文字，从每个"["处依次尝试解析
+    decoder = json.JSONDecoder()
+    start = text.find("[")
+    while start >= 0:
+        try:
+            results, _ = decoder.raw_decode(text, start)
+        except ValueError:
+            results = None
+        if isinstance(results, list) and len(results) == count:
+            return [result if isinstance(result, str) else json.dumps(result, ensure_ascii=False) for result in results]
+        start = text.find("[", start + 1)
+    return None
+
+def map_simplify_chunks(llm, prompts, direction, chunks):
+    """分析所有分块，缓存未命中的分块合并为一次llm.generate批量请求"""
+    prompt = get_simplify_prompt(*prompts)
+    prompt_texts = [
+        prompt.format(direction=direction, chunk=chunk, part=i)
+        for i, chunk in enumerate(chunks, 1)
+    ]
+    
+    use_cache = _use_llm_cache()
+    cache = get_llm_cache() if use_cache else None
+    keys = [_llm_cache_key(llm, text) for text in prompt_texts] if use_cache else [None] * len(chunks)
+    results = [cache.get(key) if use_cache else None for key in keys]
+    
+    missing = [idx for idx, result in enumerate(results) if result is None]
+    if missing:
+        try:
+            response = generate_llm(llm, [prompt_texts[idx] for idx in missing])
+            generated = [generations[0].text if generations else "" for generations in response.generations]
+        except Exception as e:
+            # 批量请求失败时逐个重新分析，单个部分失败只跳过该部分
+            dbg(f"批量分析失败，改为逐个分析: {str(e)}")
+            generated = []
+            for idx in missing:
+                try:
+                    response = generate_llm(llm, [prompt_texts[idx]])
+                    generations = response.generations[0]
+                    generated.append(generations[0].text if generations else "")
+                except Exception as e:
+                    st.error(f"处理第 {idx + 1} 部分时出错: {str(e)}")
+                    generated.append("")
+        
+        for idx, result in zip(missing, generated):
+            results[idx] = result
+            if use_cache and _is_valid_result(result):
+                cache.set(keys[idx], result, expire=LLM_CACHE_EXPIRE)
+    
+    return results
+
+# reduce阶段一次合并的分析结果token数上限，超过时先分组逐层合并
+REDUCE_GROUP_TOKENS = 6000
+
+def _group_by_tokens(texts, max_tokens):
+    """按token预算将文本顺序分组，每组至少包含一条"""
+    groups = []
+    current = []
+    current_tokens = 0
+    for text in texts:
+        tokens = _estimate_tokens(text)
+        if current and current_tokens + tokens > max_tokens:
+            groups.append(current)
+            current = []
+            current_tokens = 0
+        current.append(text)
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+def _reduce_partial_results(partial_results, direction, prompts, llm, st_container=None):
+    """将多个分析结果合并为一个，合并失败时直接拼接"""
+    joined = "\n\n".join(
+        f"[第 {i} 部分]\n{result}" for i, result in enumerate(partial_results, 1)
+    )
+    try:
+        prompt = get_reduce_prompt(*prompts)
+        chain = LLMChain(llm=llm, prompt=prompt)
+        result = cached_llm_run(chain, st_container, direction=direction, partial_results=joined)
+        if _is_valid_result(result):
+            return result
+    except Exception as e:
+        st.error(f"合并分析结果时出错: {str(e)}")
+    return "\n\n".join(partial_results)
+
+def _map_reduce_simplify(chunks, direction, prompts, stream_llm, st_container=None):
+    """分块分析后合并：map阶段批量请求，reduce阶段流式输出合并结果"""
+    # map阶段不能流式输出多个提示词，使用非流式客户端
+    map_llm = get_langchain_llm("simplify", stream=False)
+    with st.spinner(f"正在批量分析 {len(chunks)} 个部分..."):
+        try:
+            partial_results = map_simplify_chunks(map_llm, prompts, direction, chunks)
+        except Exception as e:
+            st.error(f"批量分析各部分时出错: {str(e)}")
+            return None
+    
+    partial_results = [result for result in partial_results if _is_valid_result(result)]
+    if len(partial_results) <= 1:
+        return partial_results[0] if partial_results else None
+    
+    with st.spinner("正在合并各部分分析结果..."):
+        # 结果过多时按token预算分组合并，直到剩余结果能在一次请求中合并
+        while True:
+            groups = _group_by_tokens(partial_results, REDUCE_GROUP_TOKENS)
+            if len(groups) == 1 or len(groups) == len(partial_results):
+                break
+            partial_results = [
+                group[0] if len(group) == 1 else _reduce_partial_results(group, direction, prompts, map_llm)
+                for group in groups
+            ]
+        
+        if len(partial_results) == 1:
+            return partial_results[0]
+        return _reduce_partial_results(partial_results, direction, prompts, stream_llm, st_container)
+
 def simplify_content(content, direction, st_container=None):
     """使用AI简化上传的文件内容"""
     try:
         # 记录日志，确认内容长度
-        st.write(f"准备分析的内容总长度: {len(content)} 字符")
+        dbg(f"准备分析的内容总长度: {len(content)} 字符")
         
         # 检查内容是否有效
         if not content or len(content.strip()) < 10:
@@ -281,7 +1037,7 @@ def simplify_content(content, direction, st_container=None):
             return "文档内容过短或为空，请检查上传的文件是否正确"
             
         # 获取API客户端 - 使用带有备用方案的流式输出
-        llm = get_langchain_llm("simplify", stream=True, st_container=st_container)
+        llm = get_langchain_llm("simplify", stream=True)
         
         # 从会话状态获取提示词
         backstory = st.session_state.material_backstory_prompt
@@ -289,131 +1045,306 @@ def simplify_content(content, direction, st_container=None):
         output_format = st.session_state.material_output_prompt
         
         # 清理文本，移除可能导致问题的特殊字符
-        clean_content = content.replace('{.mark}', '').replace('{.underline}', '')
-        clean_content = clean_content.replace('\x00', '')  # 移除空字符
-        clean_content = re.sub(r'\s+', ' ', clean_content)  # 规范化空白字符
+        clean_content = clean_text(content)
         
         # 记录清理后的内容长度
-        st.write(f"清理后的内容长度: {len(clean_content)} 字符")
+        dbg(f"清理后的内容长度: {len(clean_content)} 字符")
         
         # 将内容分块
         chunks = chunk_content(clean_content)
-        st.write(f"文档被分成 {len(chunks)} 个部分进行处理")
+        dbg(f"文档被分成 {len(chunks)} 个部分进行处理")
         
-        all_results = []
+        # 查询语义缓存，研究方向和文档内容相近时直接复用结果
+        # 只用于单个分块的内容，命中前分别核对研究方向和文档内容，避免把其他文档的分析结果当作命中
+        semantic_cache = None
+        if SEMANTIC_CACHE_SUPPORT and _use_llm_cache() and len(chunks) == 1:
+            prompt_key = hashlib.blake2b(
+                "\n".join([llm.model_name, backstory, task, output_format]).encode("utf-8")
+            ).hexdigest()
+            try:
+                semantic_cache = get_semantic_cache()
+                cached = semantic_cache.lookup(clean_content, direction, prompt_key)
+                if cached is not None:
+                    dbg("命中语义缓存，复用相似内容的分析结果")
+                    return cached
+            except Exception as e:
+                st.warning(f"语义缓存不可用: {str(e)}")
+                semantic_cache = None
         
-        # 处理每个块
-        for i, chunk in enumerate(chunks, 1):
-            with st.spinner(f"正在处理第 {i}/{len(chunks)} 部分..."):
+        final_result = None
+        if len(chunks) > 1:
+            # 内容较长时分块批量分析后合并
+            final_result = _map_reduce_simplify(chunks, direction, (backstory, task, output_format), llm, st_container)
+        elif chunks:
+            with st.spinner("正在处理文档内容..."):
                 # 使用管理员设置的提示词模板
-                template = f"""{backstory}
-
-{task}
-
-{output_format}
-
-重要要求:
-1. 请仔细分析文档内容，提取所有关键信息
-2. 重点关注与研究方向"{direction}"相关的内容
-3. 注意识别文档中的主要观点、论据和结论
-4. 输出应为简明扼要的要点，保持原文的层次结构
-5. 确保不遗漏任何重要信息
-6. 如果文档包含表格，请保留表格的结构和内容
-7. 如果文档包含图片，请描述图片的内容和位置
-8. 请确保输出格式清晰，使用适当的标题和列表
-9. 如果遇到无法理解的内容，请保持原文
-10. 不要重复输出相同的内容
-11. 不要生成无意义的重复文本
-12. 保持输出的简洁性和可读性
-13. 这是文档的第 {i} 部分，请专注于这部分内容
-
-研究方向: {direction}
-
-文档内容:
-{chunk}
-
-请按照以上要求分析文档内容，生成结构化的分析结果。"""
-                
-                prompt = PromptTemplate(
-                    template=template,
-                    input_variables=["direction", "chunk"]
-                )
+                chunk = chunks[0]
+                prompt = get_simplify_prompt(backstory, task, output_format)
                 
                 # 创建LLMChain
                 chain = LLMChain(llm=llm, prompt=prompt)
                 
                 try:
-                    result = chain.run(direction=direction, chunk=chunk)
-                    if result and len(result.strip()) > 10:
-                        all_results.append(result)
+                    result = cached_llm_run(chain, st_container, direction=direction, chunk=chunk, part=1)
+                    if _is_valid_result(result):
+                        final_result = result
                 except Exception as e:
-                    st.error(f"处理第 {i} 部分时出错: {str(e)}")
-                    continue
+                    st.error(f"处理文档内容时出错: {str(e)}")
         
-        # 合并所有结果
-        if not all_results:
+        # 检查结果
+        if not final_result:
             st.error("未能生成任何有效结果")
             return "AI分析未能生成有效结果。请检查文档内容是否相关，或调整提示词设置。"
         
-        final_result = "\n\n".join(all_results)
+        # 写入语义缓存
+        if semantic_cache is not None:
+            try:
+                semantic_cache.add(clean_content, direction, prompt_key, final_result)
+            except Exception as e:
+                st.warning(f"写入语义缓存失败: {str(e)}")
         
         # 记录生成结果的长度
-        st.write(f"生成的分析结果长度: {len(final_result)} 字符")
+        dbg(f"生成的分析结果长度: {len(final_result)} 字符")
         
         return final_result
     except Exception as e:
         st.error(f"分析过程中发生错误: {str(e)}")
-        st.write("错误详情：")
-        st.write(str(e))
+        dbg("错误详情：")
+        dbg(str(e))
         return f"分析过程中发生错误: {str(e)}"
 
-# 生成分析报告
-def generate_analysis(simplified_content, direction, st_container=None):
-    """使用AI生成分析报告"""
-    # 使用流式输出
-    llm = get_langchain_llm("analysis", stream=True, st_container=st_container)
+# 并发分析多个文件
+SIMPLIFY_CONCURRENCY = 5  # 同时进行的LLM请求数上限
+SIMPLIFY_BATCH_SIZE = 4  # 每次请求最多分析的片段数
+SIMPLIFY_BATCH_TOKENS = 4000  # 每次请求文档片段的token预算
+SIMPLIFY_ITEM_OUTPUT_TOKENS = 800  # 预留给每个片段分析结果的输出token数
+
+def _batch_jobs(jobs):
+    """按片段数、输入token预算和输出token预算将分析任务分组"""
+    # 所有片段的分析结果共用一次请求的输出上限
+    max_items = max(1, min(SIMPLIFY_BATCH_SIZE, LLM_MAX_TOKENS // SIMPLIFY_ITEM_OUTPUT_TOKENS))
+    batches = []
+    current = []
+    current_tokens = 0
+    for job in jobs:
+        tokens = _estimate_tokens(job[2])
+        if current and (len(current) >= max_items or current_tokens + tokens > SIMPLIFY_BATCH_TOKENS):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(job)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+async def _simplify_jobs_async(llm, jobs, file_names, prompts, direction):
+    """分组并发执行所有分析任务，用信号量限制同时进行的请求数"""
+    semaphore = asyncio.Semaphore(SIMPLIFY_CONCURRENCY)
+    use_cache = _use_llm_cache()
+    cache = get_llm_cache() if use_cache else None
+    
+    def job_key(part, chunk):
+        # 与单独分析该片段时的缓存键一致，批量和逐个分析的结果可以互相复用
+        prompt_text = get_simplify_prompt(*prompts).format(direction=direction, chunk=chunk, part=part)
+        return _llm_cache_key(llm, prompt_text)
+    
+    async def run_one(file_idx, part, chunk):
+        async with semaphore:
+            chain = LLMChain(llm=llm, prompt=get_simplify_prompt(*prompts))
+            return await cached_llm_arun(chain, direction=direction, chunk=chunk, part=part)
+    
+    async def run_batch(batch):
+        if len(batch) == 1:
+            return [await run_one(*batch[0])]
+        
+        items = "\n\n".join(
+            f"[{j}] {file_names[file_idx]} (第 {part} 部分)\n{chunk}"
+            for j, (file_idx, part, chunk) in enumerate(batch, 1)
+        )
+        try:
+            async with semaphore:
+                chain = LLMChain(llm=llm, prompt=get_batch_simplify_prompt(*prompts))
+                text = await arun_llm(chain, direction=direction, count=len(batch), items=items)
+            results = _parse_batch_result(text, len(batch))
+        except Exception as e:
+            dbg(f"批量分析 {len(batch)} 个部分失败，改为逐个分析: {str(e)}")
+            results = None
+        
+        if results is None:
+            # 批量请求失败或结果无法解析时逐个重新分析
+            return await asyncio.gather(*(run_one(*job) for job in batch), return_exceptions=True)
+        
+        # 按片段分别缓存有效的分析结果
+        if use_cache:
+            for (_, part, chunk), result in zip(batch, results):
+                if _is_valid_result(result):
+                    cache.set(job_key(part, chunk), result, expire=LLM_CACHE_EXPIRE)
+        return results
+    
+    # 已缓存的片段直接使用缓存结果，只对其余片段分组请求
+    results = [cache.get(job_key(part, chunk)) if use_cache else None for _, part, chunk in jobs]
+    pending = [idx for idx, result in enumerate(results) if result is None]
+    
+    batches = _batch_jobs([jobs[idx] for idx in pending])
+    batch_results = await asyncio.gather(*(run_batch(batch) for batch in batches), return_exceptions=True)
     
+    # 按顺序填回与jobs一一对应的位置，整组失败时每个任务都记录该错误
+    pending_results = []
+    for batch, batch_result in zip(batches, batch_results):
+        if isinstance(batch_result, Exception):
+            pending_results.extend([batch_result] * len(batch))
+        else:
+            pending_results.extend(batch_result)
+    for idx, result in zip(pending, pending_results):
+        results[idx] = result
+    return results
+
+def simplify_files(file_contents, direction):
+    """逐个文件并发分析内容，合并各文件的分析结果"""
     try:
-        # 检查简化内容是否有效
-        if not simplified_content or len(simplified_content.strip()) < 100:
-            return "无法生成报告，因为文档分析阶段未能产生足够深入的内容。请返回上一步重试，调整研究方向或上传更相关的文档。"
-            
-        # 从会话状态获取提示词
-        backstory = st.session_state.brainstorm_backstory_prompt
-        task = st.session_state.brainstorm_task_prompt
-        output_format = st.session_state.brainstorm_output_prompt
+        llm = get_langchain_llm("simplify", stream=False, reuse_client=False)
+        prompts = (
+            st.session_state.material_backstory_prompt,
+            st.session_state.material_task_prompt,
+            st.session_state.material_output_prompt,
+        )
         
-        # 增强提示模板的明确性和结构
-        template = f"""{backstory}
+        # 每个文件单独清理和分块，任务记录所属文件的序号
+        jobs = []
+        for file_idx, (_, content) in enumerate(file_contents):
+            for part, chunk in enumerate(chunk_content(clean_text(content)), 1):
+                jobs.append((file_idx, part, chunk))
+        dbg(f"{len(file_contents)} 个文件被分成 {len(jobs)} 个部分并发处理")
+        
+        if not jobs:
+            st.error("文档内容过短或为空")
+            return "文档内容过短或为空，请检查上传的文件是否正确"
+        
+        file_names = [file_name for file_name, _ in file_contents]
+        results = asyncio.run(_simplify_jobs_async(llm, jobs, file_names, prompts, direction))
+        
+        # 按文件汇总结果
+        file_results = [[] for _ in file_contents]
+        for (file_idx, part, _), result in zip(jobs, results):
+            if isinstance(result, Exception):
+                st.error(f"处理文件 {file_contents[file_idx][0]} 第 {part} 部分时出错: {str(result)}")
+            elif _is_valid_result(result):
+                file_results[file_idx].append(result)
+        
+        sections = [
+            f"===== 文件: {file_name} =====\n\n" + "\n\n".join(parts)
+            for (file_name, _), parts in zip(file_contents, file_results) if parts
+        ]
+        if not sections:
+            st.error("未能生成任何有效结果")
+            return "AI分析未能生成有效结果。请检查文档内容是否相关，或调整提示词设置。"
+        
+        final_result = "\n\n".join(sections)
+        dbg(f"生成的分析结果长度: {len(final_result)} 字符")
+        return final_result
+    except Exception as e:
+        st.error(f"分析过程中发生错误: {str(e)}")
+        return f"分析过程中发生错误: {str(e)}"
+
+@st.cache_resource(show_spinner=False)
+def get_analysis_prompt(backstory, task, output_format):
+    """构建脑暴报告的提示词模板，提示词不变时直接复用"""
+    template = f"""{_escape_braces(backstory)}
 
-{task}
+{_escape_braces(task)}
 
-{output_format}
+{_escape_braces(output_format)}
 
 重要要求:
 1. 基于提供的分析结果，生成一份详尽、实用的报告
-2. 报告必须与研究方向"{direction}"紧密结合
+2. 报告必须与研究方向"{{direction}}"紧密结合
 3. 提供具体的、可实施的策略和方案
 4. 包含清晰的结构和小标题
 5. 内容必须具备原创性和创新性
 
-研究方向: {direction}
+研究方向: {{direction}}
 
 分析结果:
-{simplified_content}
+{{simplified_content}}
 
 请生成一份全面的申请策略和提升方案报告，确保包含明确的小标题和结构化内容。"""
+    
+    return PromptTemplate(
+        template=template,
+        input_variables=["direction", "simplified_content"]
+    )
+
+# 素材分析结果超过报告提示词的上下文预算时，先压缩为摘要再生成报告
+# 与reduce阶段一次合并的预算一致，单个文档的分析结果不会触发压缩
+ANALYSIS_CONTEXT_TOKENS = REDUCE_GROUP_TOKENS
+# 压缩后摘要的目标字数
+ANALYSIS_DIGEST_CHARS = 1000
+
+@st.cache_resource(show_spinner=False)
+def get_digest_prompt():
+    """构建将素材分析结果压缩为摘要的提示词模板"""
+    template = f"""以下是针对研究方向"{{direction}}"的素材分析结果，请将其压缩为一份精炼的摘要:
+1. 保留与研究方向相关的所有关键信息、数据和结论
+2. 合并重复的要点，删除冗余的描述
+3. 使用要点列表，保持清晰的层次结构
+4. 摘要总长度控制在{ANALYSIS_DIGEST_CHARS}字以内
+
+研究方向: {{direction}}
+
+素材分析结果:
+{{simplified_content}}
+
+请输出压缩后的摘要。"""
+    
+    return PromptTemplate(
+        template=template,
+        input_variables=["direction", "simplified_content"]
+    )
+
+def digest_simplified_content(simplified_content, direction):
+    """素材分析结果超出上下文预算时压缩为固定长度的摘要，失败时返回原内容"""
+    if _estimate_tokens(simplified_content) <= ANALYSIS_CONTEXT_TOKENS:
+        return simplified_content
+    
+    try:
+        llm = get_langchain_llm("simplify", stream=False)
+        chain = LLMChain(llm=llm, prompt=get_digest_prompt())
+        digest = cached_llm_run(chain, min_length=100, direction=direction, simplified_content=simplified_content)
+        if _is_valid_result(digest, 100):
+            dbg(f"素材分析结果从 {len(simplified_content)} 字符压缩为 {len(digest)} 字符")
+            return digest
+    except Exception as e:
+        st.warning(f"压缩素材分析结果失败，使用完整内容生成报告: {str(e)}")
+    return simplified_content
+
+# 生成分析报告
+def generate_analysis(simplified_content, direction, st_container=None):
+    """使用AI生成分析报告"""
+    # 使用流式输出
+    llm = get_langchain_llm("analysis", stream=True)
+    
+    try:
+        # 检查简化内容是否有效
+        if not simplified_content or len(simplified_content.strip()) < 100:
+            return "无法生成报告，因为文档分析阶段未能产生足够深入的内容。请返回上一步重试，调整研究方向或上传更相关的文档。"
+            
+        # 从会话状态获取提示词
+        backstory = st.session_state.brainstorm_backstory_prompt
+        task = st.session_state.brainstorm_task_prompt
+        output_format = st.session_state.brainstorm_output_prompt
         
-        prompt = PromptTemplate(
-            template=template,
-            input_variables=["direction", "simplified_content"]
-        )
+        # 增强提示模板的明确性和结构
+        prompt = get_analysis_prompt(backstory, task, output_format)
+        
+        # 只发送压缩后的摘要，完整的分析结果仍保存在会话状态中用于显示
+        digest = digest_simplified_content(simplified_content, direction)
         
         # 创建LLMChain
         chain = LLMChain(llm=llm, prompt=prompt)
         
         # 执行链
-        result = chain.run(direction=direction, simplified_content=simplified_content)
+        result = cached_llm_run(chain, st_container, min_length=200, direction=direction, simplified_content=digest)
         
         # 如果返回为空或过短，提供更明确的错误信息
         if not result or len(result.strip()) < 200:
@@ -467,6 +1398,12 @@ if 'brainstorm_task_prompt' not in st.session_state:
 if 'brainstorm_output_prompt' not in st.session_state:
     st.session_state.brainstorm_output_prompt = "报告应包括关键发现、创新思路、潜在机会和具体建议，格式清晰易读。"
 
+# 侧边栏调试开关，默认值可在secrets.toml中通过DEBUG设置
+# 先检查secrets文件是否存在，避免Streamlit在没有secrets.toml时显示报错
+debug_default = st.secrets.load_if_toml_exists() and bool(st.secrets.get("DEBUG", False))
+st.sidebar.toggle("调试日志", value=debug_default, key="debug",
+                  help="显示文件读取、内容长度和分块等处理细节")
+
 # 创建两个标签页
 tab1, tab2 = st.tabs(["脑暴助理", "管理员设置"])
 
@@ -486,38 +1423,44 @@ with tab1:
                              height=100, 
                              help="详细描述您的研究方向，帮助AI更好地理解您的需求")
     
-    if st.button("开始素材分析", disabled=not uploaded_files or not direction):
-        # 保存上传的文件到临时目录
-        temp_dir = tempfile.mkdtemp()
-        file_paths = []
-        
-        # 保存文件并添加到处理列表
+    st.checkbox("使用缓存", value=True, key="use_cache",
+                help="相同的文件内容、研究方向和提示词将直接返回上次的分析结果")
+    
+    # 分步执行或一次性执行完整流程
+    col_simplify, col_pipeline = st.columns(2)
+    with col_simplify:
+        run_simplify = st.button("开始素材分析", disabled=not uploaded_files or not direction)
+    with col_pipeline:
+        run_pipeline = st.button("一键生成脑暴报告", disabled=not uploaded_files or not direction,
+                                 help="连续执行素材分析和脑暴报告生成，无需再次点击")
+    
+    if run_simplify or run_pipeline:
+        # 直接在内存中读取上传的文件，无需写入临时目录
+        uploads = []
         for file in uploaded_files:
             # 使用安全的文件名，移除特殊字符
-            safe_filename = re.sub(r'[^\w\-\.]', '_', file.name)
-            file_path = os.path.join(temp_dir, safe_filename)
-            with open(file_path, "wb") as f:
-                f.write(file.getbuffer())
-            file_paths.append(file_path)
-            st.write(f"保存文件: {file.name} -> {file_path}, 大小: {len(file.getbuffer())} 字节")
+            safe_filename = _SAFE_NAME_RE.sub('_', file.name)
+            file_bytes = file.getvalue()
+            uploads.append((safe_filename, file_bytes))
+            dbg(f"读取文件: {file.name} -> {safe_filename}, 大小: {len(file_bytes)} 字节")
         
         # 确保立即保存方向信息到会话状态
-        st.session_state.uploaded_files = file_paths
+        st.session_state.uploaded_files = [file_name for file_name, _ in uploads]
         st.session_state.direction = direction
         
-        # 处理上传的文件内容，逐个处理每个文件并收集内容
-        all_content = ""
-        for file_path in file_paths:
-            file_ext = Path(file_path).suffix.lower().replace(".", "")
-            
-            # 使用process_file函数提取文件内容，并添加到all_content
-            content = process_file(file_path, file_ext)
-            file_name = os.path.basename(file_path)
+        # 并行处理上传的文件内容，相同内容直接复用缓存的解析结果，日志在线程结束后统一输出
+        results = asyncio.run(extract_files_async(uploads))
+        
+        # 按上传顺序收集内容
+        file_contents = []
+        for file_name, content, logs in results:
+            for level, message in logs:
+                _show_log(level, message)
             
-            all_content += f"\n\n===== 文件: {file_name} =====\n\n{content}"
+            file_contents.append((file_name, content))
             
         # 验证文件内容不为空
-        if not all_content or len(all_content.strip()) < 50:
+        if sum(len(content.strip()) for _, content in file_contents) < 50:
             st.error("❌ 文件内容似乎为空或过短。请确保上传了有效的文件。")
             st.stop()
         
@@ -526,16 +1469,38 @@ with tab1:
         
         # 简化内容
         with st.spinner("正在分析素材..."):
-            # 调用AI分析内容
-            simplified = simplify_content(all_content, direction, st_container=analysis_container)
+            # 调用AI分析内容，完整流程模式下各文件并发分析
+            if run_pipeline:
+                simplified = simplify_files(file_contents, direction)
+            else:
+                # 仅在整体分析时才拼接全部文件内容
+                all_content = "".join(
+                    f"\n\n===== 文件: {file_name} =====\n\n{content}" for file_name, content in file_contents
+                )
+                simplified = simplify_content(all_content, direction, st_container=analysis_container)
             
             # 确保立即保存简化内容到会话状态
             st.session_state.simplified_content = simplified
             st.session_state.show_analysis_section = True
         
+        # 流式输出完成后清空临时容器，由下方统一显示结果
+        analysis_container.empty()
+        
         # 显示结果
         st.subheader("素材分析结果")
         st.markdown(simplified)
+        
+        # 完整流程模式下直接生成脑暴报告
+        if run_pipeline:
+            report_container = st.empty()
+            
+            with st.spinner("正在生成脑暴报告..."):
+                report = generate_analysis(simplified, direction, st_container=report_container)
+                st.session_state.analysis_report = report
+            report_container.empty()
+            
+            st.subheader("脑暴报告")
+            st.markdown(report)
     
     # 第二步：生成头脑风暴辅助报告
     if st.session_state.show_analysis_section or st.session_state.simplified_content:
@@ -555,6 +1520,7 @@ with tab1:
             with st.spinner("正在生成脑暴报告..."):
                 report = generate_analysis(st.session_state.simplified_content, st.session_state.direction, st_container=report_container)
                 st.session_state.analysis_report = report
+            report_container.empty()
             
             # 显示结果
             st.subheader("脑暴报告")